@@ -1,42 +1,72 @@
 import streamlit as st
-import fitz
-import hashlib
-import requests
+import xxhash
+import diskcache
+import httpx
+import asyncio
 import os
-from pptx import Presentation
-from pptx.util import Pt, Inches
-from pptx.enum.text import PP_ALIGN
-from pptx.dml.color import RGBColor
-from docx import Document
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pipeline import BATCH_MP_CONTEXT, build_reports, extract_text_from_pdf
 from io import BytesIO
 from datetime import datetime, timedelta
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 import pandas as pd
 import base64
-import json
+import orjson
+import stat
 import uuid
-import io
-import csv
 import re
 
 
 # ===== 配置 =====
-DEEPSEEK_API_KEY = st.secrets.get("DEEPSEEK_API_KEY", "")
-if not DEEPSEEK_API_KEY:
-    st.error("请在 .streamlit/secrets.toml 中设置 DEEPSEEK_API_KEY")
+DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 
 # 常量定义
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200MB
 MAX_FILES_PER_BATCH = 5
+HISTORY_PAGE_SIZE = 10
+MAX_WORKERS = min(os.cpu_count() or 1, 4)  # 批处理进程池大小
+MAX_TEXT_BYTES = 90_000  # 送入模型的文本上限（约 3 万个汉字）
 UPLOAD_DIR = "uploaded_pdfs"
-LOGO_PATH = "bofu_logo.png"  # 移动到配置部分
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+EXPORT_DIR = "exports"  # 历史记录的导出文件，与上传目录分开，避免被“清理上传文件”删除
+DS_CACHE_DIR = ".ds_cache"
+
+_SUPP_RE = re.compile(r"补充说明[：:]\s*(.*?)(?=\n\n|\Z)", re.DOTALL)
+
+def get_api_key():
+    """读取 DeepSeek API Key；放在函数中而非模块顶层，子进程导入本脚本时不会触发 Streamlit 运行时"""
+    try:
+        return st.secrets.get("DEEPSEEK_API_KEY", "")
+    except FileNotFoundError:
+        # 没有 secrets.toml 时 st.secrets 会抛出 StreamlitSecretNotFoundError（FileNotFoundError 的子类）
+        return ""
+
+@st.cache_resource(show_spinner=False)
+def get_batch_executor():
+    """整个服务共用的批处理进程池，避免每批文件都重新启动子进程"""
+    return ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=BATCH_MP_CONTEXT)
+
+def submit_batch_job(fn, *args):
+    """提交任务到共享进程池；进程池因子进程崩溃失效时重建一次"""
+    try:
+        return get_batch_executor().submit(fn, *args)
+    except BrokenProcessPool:
+        get_batch_executor.clear()
+        return get_batch_executor().submit(fn, *args)
 
 # ===== 文件处理函数 =====
-def validate_file(uploaded_file):
-    """验证上传文件的大小和类型"""
-    if len(uploaded_file.getvalue()) > MAX_FILE_SIZE:
+def _size_and_hash(uploaded_file):
+    """一次遍历上传缓冲区完成大小检查与哈希计算，超限时返回 (None, None)"""
+    buf = uploaded_file.getbuffer()
+    if len(buf) > MAX_FILE_SIZE:
+        return None, None
+    h = xxhash.xxh3_64()
+    h.update(buf)
+    return bytes(buf), h.hexdigest()
+
+def validate_file(uploaded_file, file_bytes):
+    """验证上传文件的大小和类型，file_bytes 为 _size_and_hash 的结果"""
+    if file_bytes is None:
         st.error(f"文件大小超过限制（200MB）：{uploaded_file.name}")
         return False
     if not uploaded_file.name.lower().endswith('.pdf'):
@@ -50,128 +80,16 @@ def sanitize_filename(filename):
     filename = ''.join(c for c in filename if c in safe_chars)
     return filename or "unnamed_file"
 
-def process_large_file(uploaded_file):
-    """分块处理大文件以优化内存使用"""
-    chunk_size = 1024 * 1024  # 1MB chunks
-    file_bytes = uploaded_file.getvalue()
-    total_chunks = (len(file_bytes) + chunk_size - 1) // chunk_size
-    
-    progress_bar = st.progress(0)
-    text_blocks = []
-    
-    for i in range(0, len(file_bytes), chunk_size):
-        chunk = file_bytes[i:i + chunk_size]
-        doc = fitz.open(stream=chunk, filetype="pdf")
-        
-        for page in doc:
-            blocks = page.get_text("blocks")
-            for b in blocks:
-                if b[6] == 0:
-                    clean_text = b[4].replace('\x00', '').strip()
-                    if clean_text and len(clean_text) > 20:
-                        text_blocks.append(clean_text)
-        
-        progress = (i + chunk_size) / len(file_bytes)
-        progress_bar.progress(min(progress, 1.0))
-    
-    return "\n".join(text_blocks)
-
-def process_file_with_status(uploaded_file):
-    """添加处理状态提示的文件处理函数"""
-    status_placeholder = st.empty()
-    progress_placeholder = st.empty()
-    progress_bar = progress_placeholder.progress(0)
-    
-    try:
-        # 步骤1：验证文件
-        status_placeholder.info("📑 验证文件...")
-        if not validate_file(uploaded_file):
-            status_placeholder.error("❌ 文件验证失败")
-            return None
-        progress_bar.progress(25)
-        
-        # 步骤2：提取文本
-        status_placeholder.info("📖 提取文本...")
-        file_bytes = uploaded_file.getvalue()
-        file_hash = hashlib.md5(file_bytes).hexdigest()
-        full_text = extract_text_from_pdf_by_hash(file_hash, file_bytes)
-        if not full_text:
-            status_placeholder.error("❌ 文本提取失败")
-            return None
-        progress_bar.progress(50)
-        
-        # 步骤3：分析内容
-        status_placeholder.info("🤖 分析内容...")
-        trimmed_text = full_text[:30000]
-        text_hash = hashlib.md5(trimmed_text.encode("utf-8")).hexdigest()
-        result = extract_study_by_hash(text_hash, trimmed_text)
-        if not result:
-            status_placeholder.error("❌ 内容分析失败")
-            return None
-        progress_bar.progress(75)
-        
-        # 步骤4：生成报告
-        status_placeholder.info("📊 生成报告...")
-        try:
-            # 生成CSV
-            csv_lines = []
-            for line in result.splitlines():
-                if "|" in line and not line.startswith("|---") and not line.lower().startswith("| 要素"):
-                    parts = [p.strip() for p in line.strip("|").split("|")]
-                    if len(parts) >= 2:
-                        csv_lines.append(",".join(parts))
-            csv_lines.insert(0, "要素,内容")
-            
-            # 生成PPT
-            prs = Presentation()
-            prs.slide_width = Inches(13.33)
-            prs.slide_height = Inches(7.5)
-            
-            # 生成Word
-            word_bytes = generate_word_table(csv_lines, "博扶AI创意组", uploaded_file.name)
-            
-            progress_bar.progress(100)
-            status_placeholder.success("✅ 处理完成")
-            return result, csv_lines, prs, word_bytes
-            
-        except Exception as e:
-            status_placeholder.error("❌ 报告生成失败")
-            return None
-            
-    except Exception as e:
-        status_placeholder.error("❌ 处理失败")
-        return None
-    finally:
-        # 清理状态显示
-        progress_placeholder.empty()
-        status_placeholder.empty()
-
 # ===== 文本提取函数 =====
-@st.cache_data(show_spinner="📖 正在解析 PDF", max_entries=100)
-def extract_text_from_pdf_by_hash(file_hash: str, file_bytes: bytes):
-    """根据文件大小选择处理方式"""
-    if len(file_bytes) > MAX_FILE_SIZE:
-        return process_large_file(file_bytes)
-    else:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        text_blocks = []
-        for page in doc:
-            blocks = page.get_text("blocks")
-            for b in blocks:
-                if b[6] == 0:
-                    clean_text = b[4].replace('\x00', '').strip()
-                    if clean_text and len(clean_text) > 20:
-                        text_blocks.append(clean_text)
-        return "\n".join(text_blocks)
-
-@st.cache_data(show_spinner="🤖 正在调用模型...", max_entries=100)
-def extract_study_by_hash(text_hash: str, text: str):
-    return extract_study_design(text)
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def extract_study_design(text):
-    """提取研究设计信息，带重试机制"""
-    prompt = f"""作为临床研究专家，请从以下文献中提取结构化研究设计信息，并输出为 Markdown 表格，包含以下字段：
+def trim_text(full_text):
+    """按 UTF-8 字节截断送入模型的文本，返回 (文本哈希, 截断后文本)"""
+    trimmed_bytes = full_text.encode("utf-8")[:MAX_TEXT_BYTES]
+    # 截断处可能切开多字节字符，解码时忽略残缺的尾部
+    return xxhash.xxh3_64_hexdigest(trimmed_bytes), trimmed_bytes.decode("utf-8", "ignore")
+
+def build_study_prompt(text):
+    """构造研究设计信息提取的提示词"""
+    return f"""作为临床研究专家，请从以下文献中提取结构化研究设计信息，并输出为 Markdown 表格，包含以下字段：
 
 | 要素 | 内容 |
 |------|------|
@@ -192,26 +110,71 @@ def extract_study_design(text):
 文献内容如下：
 {text}
 """
+
+async def _call_deepseek(client, prompt):
+    """调用 DeepSeek 提取研究设计信息，网络错误时指数退避重试"""
+    async for attempt in AsyncRetrying(stop=stop_after_attempt(3),
+                                       wait=wait_exponential(multiplier=1, min=4, max=10),
+                                       retry=retry_if_exception_type(httpx.HTTPError),
+                                       reraise=True):
+        with attempt:
+            try:
+                response = await client.post(
+                    DEEPSEEK_API_URL,
+                    json={
+                        "model": "deepseek-chat",
+                        "messages": [{"role": "user", "content": prompt}],
+                        "temperature": 0,
+                        "max_tokens": 4000
+                    },
+                    timeout=90
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                st.error(f"模型调用失败（将自动重试）：{e}")
+                raise
+            try:
+                return response.json()["choices"][0]["message"]["content"]
+            except Exception as e:
+                st.error(f"处理过程中发生错误：{e}")
+                return ""
+
+async def _fanout(prompts):
+    """在同一个 HTTP/2 连接上并发发出所有请求，单个失败不影响其他文件"""
+    async with httpx.AsyncClient(http2=True, headers={"Authorization": f"Bearer {get_api_key()}"}) as client:
+        return await asyncio.gather(*(_call_deepseek(client, p) for p in prompts), return_exceptions=True)
+
+@st.cache_resource(show_spinner=False)
+def get_ds_cache():
+    """模型结果的磁盘缓存，按文本哈希索引，重启后依然有效；整个进程共用一个实例，不随页面重跑重复打开"""
+    return diskcache.Cache(DS_CACHE_DIR, size_limit=2 << 30)
+
+def _cache_get(text_hash):
+    """读取缓存的模型结果，缓存不可用时视为未命中"""
     try:
-        response = requests.post(
-            "https://api.deepseek.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}"},
-            json={
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0,
-                "max_tokens": 4000
-            },
-            timeout=90
-        )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-    except requests.exceptions.RequestException as e:
-        st.error(f"模型调用失败（将自动重试）：{e}")
-        raise
+        return get_ds_cache().get(text_hash)
     except Exception as e:
-        st.error(f"处理过程中发生错误：{e}")
-        return ""
+        print(f"读取模型结果缓存失败，将直接调用模型: {str(e)}")
+        return None
+
+def _cache_set(text_hash, result):
+    """写入模型结果缓存，失败时只记录日志"""
+    try:
+        get_ds_cache()[text_hash] = result
+    except Exception as e:
+        print(f"写入模型结果缓存失败: {str(e)}")
+
+def analyze_texts(items):
+    """批量分析 (文本哈希, 文本)：先查磁盘缓存，未命中的再并发调用模型并写回缓存"""
+    results = [_cache_get(text_hash) for text_hash, _ in items]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        fresh = asyncio.run(_fanout([build_study_prompt(items[i][1]) for i in missing]))
+        for i, result in zip(missing, fresh):
+            results[i] = result
+            if isinstance(result, str) and result:
+                _cache_set(items[i][0], result)
+    return results
 
 def extract_supplementary_notes(result):
     """提取补充说明内容"""
@@ -219,43 +182,49 @@ def extract_supplementary_notes(result):
         return None
     
     # 使用更精确的方式检测补充说明
-    supplementary_pattern = r"补充说明[：:]\s*(.*?)(?=\n\n|\Z)"
-    match = re.search(supplementary_pattern, result, re.DOTALL)
+    match = _SUPP_RE.search(result)
     
     if match:
         return match.group(1).strip()
     return None
 
-# ===== 文档生成函数 =====
-def generate_word_table(csv_lines, team_name, source_file):
-    doc = Document()
-    heading = doc.add_heading(f"{team_name} · 临床研究结构化提取报告", 0)
-    heading.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    subtitle = doc.add_paragraph(f"📄 来源文献：{source_file}", style="Intense Quote")
-    subtitle.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    doc.add_paragraph()
-    table = doc.add_table(rows=0, cols=2)
-    table.style = 'Table Grid'
-    for row in csv_lines[1:]:
-        if "," in row:
-            key, value = row.split(",", 1)
-            cells = table.add_row().cells
-            cells[0].text = key.strip()
-            cells[1].text = value.strip()
-    for row in table.rows:
-        for cell in row.cells:
-            for para in cell.paragraphs:
-                para.paragraph_format.line_spacing = 1.5
-                para.paragraph_format.space_after = Pt(6)
-                para.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-                para.runs[0].font.size = Pt(11)
-    doc.add_paragraph(f"导出时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    word_stream = BytesIO()
-    doc.save(word_stream)
-    word_stream.seek(0)
-    return word_stream
-
 # ===== 历史记录管理函数 =====
+def _record_ts(record):
+    """记录创建时间的 Unix 时间戳，兼容没有 ts 字段的旧记录"""
+    if 'ts' in record:
+        return record['ts']
+    return int(datetime.strptime(record['时间'], '%Y-%m-%d %H:%M:%S').timestamp())
+
+def _drop_expired(records):
+    """清理超过1周的记录，连同其导出文件一并删除"""
+    cutoff = int((datetime.now() - timedelta(days=7)).timestamp())
+    kept = []
+    for record in records:
+        if _record_ts(record) > cutoff:
+            kept.append(record)
+        else:
+            remove_record_files(record)
+    return kept
+
+def _migrate_legacy_files(records):
+    """将旧格式记录中 base64 编码的导出文件（文件数据）写入导出目录，返回是否有记录被迁移"""
+    migrated = False
+    for record in records:
+        if '文件数据' not in record or 'files' in record:
+            continue
+        try:
+            blobs = record['文件数据']
+            record['files'] = save_record_files(record['id'],
+                                                BytesIO(base64.b64decode(blobs['CSV'])),
+                                                BytesIO(base64.b64decode(blobs['PPT'])),
+                                                BytesIO(base64.b64decode(blobs['Word'])))
+        except Exception as e:
+            print(f"迁移记录 {record.get('id')} 的导出文件失败: {str(e)}")
+            continue
+        del record['文件数据']
+        migrated = True
+    return migrated
+
 def load_history():
     """从本地文件加载历史记录"""
     history_file = 'history.json'
@@ -264,8 +233,8 @@ def load_history():
         return []
     
     try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(history_file, 'rb') as f:
+            data = orjson.loads(f.read())
             if not isinstance(data, dict) or 'records' not in data:
                 print("历史记录文件格式错误，将重置记录")
                 return []
@@ -274,14 +243,11 @@ def load_history():
                 print("历史记录格式错误，将重置记录")
                 return []
             
-            # 清理超过1周的记录
-            current_time = datetime.now()
-            one_week_ago = current_time - timedelta(days=7)
-            cleaned_records = [
-                record for record in records 
-                if datetime.strptime(record['时间'], '%Y-%m-%d %H:%M:%S') > one_week_ago
-            ]
-            return cleaned_records
+            records = _drop_expired(records)
+            # 旧格式记录只迁移一次，迁移后立即写回
+            if _migrate_legacy_files(records):
+                save_history(records)
+            return records
     except Exception as e:
         print(f"加载历史记录时发生错误: {str(e)}")
         return []
@@ -293,13 +259,7 @@ def save_history(records):
         return False
     
     try:
-        # 清理超过1周的记录
-        current_time = datetime.now()
-        one_week_ago = current_time - timedelta(days=7)
-        cleaned_records = [
-            record for record in records 
-            if datetime.strptime(record['时间'], '%Y-%m-%d %H:%M:%S') > one_week_ago
-        ]
+        cleaned_records = _drop_expired(records)
         
         data = {
             "records": cleaned_records,
@@ -309,13 +269,70 @@ def save_history(records):
                 "cleaned_records": len(records) - len(cleaned_records)
             }
         }
-        with open('history.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # 先写临时文件再原子替换，避免写入中断导致历史记录损坏
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        # 以 0666 创建临时文件，由内核按 umask 得出新文件的权限；已有历史记录文件时沿用其权限
+        tmp_path = f".history-{uuid.uuid4().hex}.json.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            try:
+                os.chmod(tmp_path, stat.S_IMODE(os.stat('history.json').st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, 'history.json')
+        except Exception:
+            os.remove(tmp_path)
+            raise
         return True
     except Exception as e:
         print(f"保存历史记录时发生错误: {str(e)}")
         return False
 
+def save_record_files(record_id, csv_bytes, pptx_bytes, word_bytes):
+    """将导出文件写入导出目录，返回各文件路径"""
+    files = {
+        "CSV": os.path.join(EXPORT_DIR, f"{record_id}.csv"),
+        "PPT": os.path.join(EXPORT_DIR, f"{record_id}.pptx"),
+        "Word": os.path.join(EXPORT_DIR, f"{record_id}.docx")
+    }
+    for kind, data in (("CSV", csv_bytes), ("PPT", pptx_bytes), ("Word", word_bytes)):
+        with open(files[kind], 'wb') as f:
+            f.write(data.getvalue())
+    return files
+
+@st.cache_resource(max_entries=30, show_spinner=False)
+def load_record_file(path):
+    """按需读取历史记录对应的导出文件，重跑页面时复用已读取的内容"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def load_outputs_from_history(file_hash):
+    """若历史记录中已有相同文件，返回其提取内容与导出文件，否则返回 None"""
+    existing = next((r for r in reversed(st.session_state.history) if r.get('hash') == file_hash), None)
+    if existing is None:
+        return None
+    try:
+        return (existing['提取内容'],
+                BytesIO(load_record_file(existing['files']['CSV'])),
+                BytesIO(load_record_file(existing['files']['PPT'])),
+                BytesIO(load_record_file(existing['files']['Word'])))
+    except (KeyError, OSError) as e:
+        print(f"历史记录中的导出文件不可用，将重新处理: {str(e)}")
+        return None
+
+def remove_record_files(record):
+    """删除历史记录对应的导出文件，单个文件删除失败时记录日志并继续"""
+    for path in record.get('files', {}).values():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"删除导出文件 {path} 失败: {str(e)}")
+    load_record_file.clear()
+
 def delete_record(record_id):
     """删除单条历史记录"""
     if not record_id:
@@ -334,6 +351,10 @@ def delete_record(record_id):
         if len(st.session_state.history) == original_length:
             print(f"未找到ID为 {record_id} 的记录")
             return False
+
+        for r in records:
+            if r.get('id') == record_id:
+                remove_record_files(r)
             
         if save_history(st.session_state.history):
             print(f"成功删除记录 {record_id}")
@@ -350,7 +371,7 @@ def show_history():
     st.subheader("📜 处理历史记录")
     if len(st.session_state.history) > 0:
         history_df = pd.DataFrame(st.session_state.history)
-        history_df['时间'] = pd.to_datetime(history_df['时间'])
+        history_df['时间'] = pd.to_datetime(history_df['时间'], format='%Y-%m-%d %H:%M:%S', cache=True)
         history_df.sort_values('时间', ascending=False, inplace=True)
 
         # 展示历史记录表格
@@ -372,6 +393,28 @@ def show_history():
     else:
         st.warning("没有历史记录。")
 
+def show_result(file_name, result, csv_bytes, pptx_bytes, word_bytes):
+    """在当前标签页中展示提取结果与下载按钮"""
+    st.success("✅ 已成功提取结构化研究设计信息")
+    st.markdown(result.strip(), unsafe_allow_html=True)
+
+    # 添加提示信息
+    st.info("💡 提示：请及时下载生成的文件，历史记录将在7天后自动清理。")
+    st.warning("⚠️ 注意：文件仅保存在浏览器会话中，关闭页面后将无法访问。")
+
+    # 生成文件名
+    today = datetime.now().strftime("%Y%m%d")
+    base_name = os.path.splitext(file_name)[0]
+
+    st.markdown("#### 📁 下载导出文件")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button("📥 下载 CSV", csv_bytes, f"{today}_{base_name}_结构化.csv", mime="text/csv")
+    with col2:
+        st.download_button("📊 下载 PPT", pptx_bytes, f"{today}_{base_name}_结构化.pptx", mime="application/vnd.openxmlformats-officedocument.presentationml.presentation")
+    with col3:
+        st.download_button("📄 下载 Word", word_bytes, f"{today}_{base_name}_结构化.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+
 def clear_uploaded_files():
     """清理上传的文件"""
     if "uploaded_pdfs" in os.listdir():
@@ -402,216 +445,177 @@ def admin_dashboard():
         st.write("退出后台管理界面")
 
 # ===== 主程序 =====
-st.set_page_config(layout="wide", page_title="临床研究设计结构化助手")
-page = st.radio("选择页面", ["主页", "后台管理"], horizontal=True)
-
-# 初始化或加载历史记录
-if 'history' not in st.session_state:
-    st.session_state.history = load_history()
-
-if page == "主页":
-    # 上传文献并展示结构化提取结果
-    st.markdown('<div style="display: flex; align-items: flex-start; padding-top: 12px; font-size: 45px;">🤖</div>', unsafe_allow_html=True)
-    st.markdown('<h1 style="margin: 0;">临床研究设计结构化助手</h1>', unsafe_allow_html=True)
-    st.caption("💡 自动识别 PDF 文献中的研究设计信息，支持导出为 CSV / PPT / Word")
+def main():
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+
+    st.set_page_config(layout="wide", page_title="临床研究设计结构化助手")
+    if not get_api_key():
+        st.error("请在 .streamlit/secrets.toml 中设置 DEEPSEEK_API_KEY")
+    page = st.radio("选择页面", ["主页", "后台管理"], horizontal=True)
+
+    # 初始化或加载历史记录
+    if 'history' not in st.session_state:
+        st.session_state.history = load_history()
+
+    if page == "主页":
+        # 上传文献并展示结构化提取结果
+        st.markdown('<div style="display: flex; align-items: flex-start; padding-top: 12px; font-size: 45px;">🤖</div>', unsafe_allow_html=True)
+        st.markdown('<h1 style="margin: 0;">临床研究设计结构化助手</h1>', unsafe_allow_html=True)
+        st.caption("💡 自动识别 PDF 文献中的研究设计信息，支持导出为 CSV / PPT / Word")
     
-    # 添加处理状态说明
-    with st.expander("💡 处理说明", expanded=False):
-        st.info("""
-        **处理步骤：**
-        1. 📑 验证文件
-        2. 📖 提取文本
-        3. 🤖 分析内容
-        4. 📊 生成报告
+        # 添加处理状态说明
+        with st.expander("💡 处理说明", expanded=False):
+            st.info("""
+            **处理步骤：**
+            1. 📑 验证文件
+            2. 📖 提取文本
+            3. 🤖 分析内容
+            4. 📊 生成报告
         
-        **提示：**
-        - 每篇文献处理时间约1-2分钟
-        - 处理过程中请勿关闭页面
-        """)
+            **提示：**
+            - 每篇文献处理时间约1-2分钟
+            - 处理过程中请勿关闭页面
+            """)
     
-    uploaded_files = st.file_uploader("📄 上传PDF文件（支持多选，每个文件限制200MB）", type=["pdf"], accept_multiple_files=True)
+        uploaded_files = st.file_uploader("📄 上传PDF文件（支持多选，每个文件限制200MB）", type=["pdf"], accept_multiple_files=True)
     
-    total_files = 0
-    current_batch = []
-    queued_files = []
-
-    if uploaded_files:
-       total_files = len(uploaded_files)
-    if total_files > 5:
-        st.error(f"❌ 超出单次处理限制（5篇）")
-        # 只处理前5篇
-        current_batch = uploaded_files[:5]
-        queued_files = uploaded_files[5:]
-    else:
-        current_batch = uploaded_files
+        total_files = 0
+        current_batch = []
         queued_files = []
 
-    st.caption(f"📚 当前处理：{len(current_batch)} 篇文献" + (f" | 队列中：{len(queued_files)} 篇" if queued_files else ""))
+        if uploaded_files:
+           total_files = len(uploaded_files)
+        if total_files > 5:
+            st.error(f"❌ 超出单次处理限制（5篇）")
+            # 只处理前5篇
+            current_batch = uploaded_files[:5]
+            queued_files = uploaded_files[5:]
+        else:
+            current_batch = uploaded_files
+            queued_files = []
+
+        st.caption(f"📚 当前处理：{len(current_batch)} 篇文献" + (f" | 队列中：{len(queued_files)} 篇" if queued_files else ""))
     
-    # 处理上传的文献
-    if current_batch:
-        tabs = st.tabs([f"📄 {i+1}. {file.name}" for i, file in enumerate(current_batch)])
-
-        for idx, (tab, uploaded_file) in enumerate(zip(tabs, current_batch)):
-            with tab:
-                # 计算文件的哈希值
-                file_bytes = uploaded_file.read()
-                uploaded_file.seek(0)  # 将文件指针重置到文件开头，以便后续处理
-                file_hash = hashlib.sha256(file_bytes).hexdigest()
-
-                # 使用新的处理函数
-                result = process_file_with_status(uploaded_file)
-                
-                if not result:
-                    st.error(f"❌ 处理失败：{uploaded_file.name}")
-                    continue
-
-                result, csv_lines, prs, word_bytes = result
-                
-                # 结构化转 CSV 行
-                today = datetime.now().strftime("%Y%m%d")
-                csv_bytes = BytesIO("\n".join(csv_lines).encode("utf-8"))
-                csv_bytes.seek(0)
-
-                # ===== PPT 生成（带 LOGO 封面） =====
-                prs = Presentation()
-                prs.slide_width = Inches(13.33)
-                prs.slide_height = Inches(7.5)
-                
-                # 封面页
-                cover = prs.slides.add_slide(prs.slide_layouts[6])
-                title_box = cover.shapes.add_textbox(Inches(1), Inches(0.8), Inches(11), Inches(1.5))
-                tf = title_box.text_frame
-                p = tf.paragraphs[0]
-                run = p.add_run()
-                run.text = "研究设计提取报告"
-                run.font.size = Pt(42)
-                run.font.name = "微软雅黑"
-                run.font.bold = True
-                run.font.color.rgb = RGBColor(0, 51, 102)
-                p.alignment = PP_ALIGN.CENTER
-                
-                if os.path.exists(LOGO_PATH):
-                    cover.shapes.add_picture(LOGO_PATH, Inches(4.8), Inches(2.0), height=Inches(0.6))
-                
-                sub_box = cover.shapes.add_textbox(Inches(1), Inches(4.0), Inches(11), Inches(0.8))
-                tf2 = sub_box.text_frame
-                tf2.text = f"源文件：  {uploaded_file.name}"
-                tf2.paragraphs[0].font.size = Pt(20)
-                tf2.paragraphs[0].font.name = "微软雅黑"
-                tf2.paragraphs[0].alignment = PP_ALIGN.CENTER
-                
-                # 内容页
-                for i, row in enumerate(csv_lines[1:]):
-                    parts = row.split(",", 1)
-                    if len(parts) == 2:
-                        slide = prs.slides.add_slide(prs.slide_layouts[1])
-                        title_shape = slide.shapes.title
-                        title_shape.text = parts[0]
-                        title_frame = title_shape.text_frame
-                        title_frame.paragraphs[0].alignment = PP_ALIGN.LEFT
-                        title_run = title_frame.paragraphs[0].runs[0]
-                        title_run.font.name = "微软雅黑"
-                        title_run.font.bold = True
-                        title_run.font.color.rgb = RGBColor(0, 51, 102)
-                        
-                        textbox = slide.placeholders[1]
-                        textbox.text = parts[1].replace("；", "\n")
-                        for p in textbox.text_frame.paragraphs:
-                            for run in p.runs:
-                                run.font.size = Pt(18)
-                                run.font.name = "微软雅黑"
-                        
-                        footer = slide.shapes.add_textbox(Inches(0.5), Inches(6.9), Inches(12), Inches(0.5))
-                        tf_footer = footer.text_frame
-                        tf_footer.text = f"博扶AI创意组 · 结构化助手 · 第 {i+1} 页"
-                        tf_footer.paragraphs[0].font.size = Pt(10)
-                        tf_footer.paragraphs[0].font.name = "微软雅黑"
-                        tf_footer.paragraphs[0].alignment = PP_ALIGN.RIGHT
-                
-                # 添加补充说明页
-                if "补充说明" in result:
-                    slide = prs.slides.add_slide(prs.slide_layouts[1])
-                    title_shape = slide.shapes.title
-                    title_shape.text = "补充说明"
-                    title_frame = title_shape.text_frame
-                    title_frame.paragraphs[0].alignment = PP_ALIGN.LEFT
-                    title_run = title_frame.paragraphs[0].runs[0]
-                    title_run.font.name = "微软雅黑"
-                    title_run.font.bold = True
-                    title_run.font.color.rgb = RGBColor(0, 51, 102)
-                    
-                    textbox = slide.placeholders[1]
-                    textbox.text = result.split("补充说明：")[1].strip()
-                    for p in textbox.text_frame.paragraphs:
-                        for run in p.runs:
-                            run.font.size = Pt(18)
-                            run.font.name = "微软雅黑"
-                    
-                    footer = slide.shapes.add_textbox(Inches(0.5), Inches(6.9), Inches(12), Inches(0.5))
-                    tf_footer = footer.text_frame
-                    tf_footer.text = f"博扶AI创意组 · 结构化助手 · 补充说明页"
-                    tf_footer.paragraphs[0].font.size = Pt(10)
-                    tf_footer.paragraphs[0].font.name = "微软雅黑"
-                    tf_footer.paragraphs[0].alignment = PP_ALIGN.RIGHT
-                
-                pptx_bytes = BytesIO()
-                prs.save(pptx_bytes)
-                pptx_bytes.seek(0)
-
-                # ===== 展示结果 =====
-                st.success("✅ 已成功提取结构化研究设计信息")
-                st.markdown(result.strip(), unsafe_allow_html=True)
-                
-                # 添加提示信息
-                st.info("💡 提示：请及时下载生成的文件，历史记录将在7天后自动清理。")
-                st.warning("⚠️ 注意：文件仅保存在浏览器会话中，关闭页面后将无法访问。")
-
-                # 生成文件名
-                today = datetime.now().strftime("%Y%m%d")
-                base_name = os.path.splitext(uploaded_file.name)[0]
-
-                st.markdown("#### 📁 下载导出文件")
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.download_button("📥 下载 CSV", csv_bytes, f"{today}_{base_name}_结构化.csv", mime="text/csv")
-                with col2:
-                    st.download_button("📊 下载 PPT", pptx_bytes, f"{today}_{base_name}_结构化.pptx", mime="application/vnd.openxmlformats-officedocument.presentationml.presentation")
-                with col3:
-                    st.download_button("📄 下载 Word", word_bytes, f"{today}_{base_name}_结构化.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-
-                # 保存记录到历史
-                record = {
-                    "id": str(uuid.uuid4()),
-                    "文件名": uploaded_file.name,
-                    "hash": file_hash,
-                    "时间": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "提取内容": result.strip(),
-                    "文件数据": {
-                        "CSV": base64.b64encode(csv_bytes.getvalue()).decode('utf-8'),
-                        "PPT": base64.b64encode(pptx_bytes.getvalue()).decode('utf-8'),
-                        "Word": base64.b64encode(word_bytes.getvalue()).decode('utf-8')
-                    }
-                }
-                st.session_state.history.append(record)
-                save_history(st.session_state.history)
-
-                st.markdown("---")
-                st.subheader("📜 历史处理记录")
-                for record in st.session_state.history:
-                    with st.expander(f"📄 `{record['文件名']}`"):
-                        col1, col2 = st.columns([0.9, 0.1])
-                        with col1:
-                            st.markdown(f"📁 文件 Hash: `{record['hash']}`")
-                            st.markdown(f"⏰ 时间: {record['时间']}")
-                            st.markdown(f"📄 提取内容:\n{record['提取内容']}")
-
-                            # 从base64字符串恢复数据并提供下载
+        # 处理上传的文献
+        if current_batch:
+            tabs = st.tabs([f"📄 {i+1}. {file.name}" for i, file in enumerate(current_batch)])
+
+            # 本会话已处理过的文件直接复用结果，避免页面重跑时重复提交
+            if 'processed' not in st.session_state:
+                st.session_state.processed = {}
+
+            jobs = []
+            for idx, (tab, uploaded_file) in enumerate(zip(tabs, current_batch)):
+                # 一次读取完成大小检查与哈希计算
+                file_bytes, file_hash = _size_and_hash(uploaded_file)
+                with tab:
+                    if not validate_file(uploaded_file, file_bytes):
+                        st.error(f"❌ 处理失败：{uploaded_file.name}")
+                        continue
+                # 本会话或历史记录中已处理过相同文件时，直接复用结果，跳过整个处理流程
+                outputs = st.session_state.processed.get(file_hash) or load_outputs_from_history(file_hash)
+                if outputs:
+                    st.session_state.processed[file_hash] = outputs
+                    with tab:
+                        show_result(uploaded_file.name, *outputs)
+                else:
+                    jobs.append((idx, uploaded_file, file_bytes, file_hash))
+
+            # 各文件相互独立：文本提取与报告生成交给进程池并行，模型请求并发发出
+            if jobs:
+                status_placeholder = st.empty()
+                progress_placeholder = st.empty()
+                progress_bar = progress_placeholder.progress(0)
+
+                # 文件少于进程数时，把剩余进程分给单个文件的按页并行提取
+                page_workers = max(1, MAX_WORKERS // len(jobs))
+                # 步骤1：提取文本
+                status_placeholder.info(f"📖 正在提取 {len(jobs)} 篇文献的文本...")
+                text_futures = [submit_batch_job(extract_text_from_pdf, file_bytes, page_workers) for _, _, file_bytes, _ in jobs]
+                analyzed = []
+                for job, fut in zip(jobs, text_futures):
+                    try:
+                        full_text = fut.result()
+                    except Exception as e:
+                        print(f"提取 {job[1].name} 文本时发生错误: {str(e)}")
+                        full_text = ""
+                    if full_text:
+                        analyzed.append((job, trim_text(full_text)))
+                    else:
+                        with tabs[job[0]]:
+                            st.error(f"❌ 文本提取失败：{job[1].name}")
+                progress_bar.progress(0.25)
+
+                # 步骤2：分析内容，总耗时取决于最慢的一次请求
+                status_placeholder.info("🤖 正在分析内容...")
+                results = analyze_texts([item for _, item in analyzed])
+                progress_bar.progress(0.5)
+
+                # 步骤3：生成报告
+                status_placeholder.info("📊 正在生成报告...")
+                futures = {}
+                for ((idx, uploaded_file, _, file_hash), _), result in zip(analyzed, results):
+                    if isinstance(result, Exception) or not result:
+                        print(f"分析 {uploaded_file.name} 时发生错误: {result}")
+                        with tabs[idx]:
+                            st.error(f"❌ 内容分析失败：{uploaded_file.name}")
+                        continue
+                    futures[submit_batch_job(build_reports, result, uploaded_file.name)] = (idx, uploaded_file, file_hash, result)
+
+                for done, fut in enumerate(as_completed(futures), start=1):
+                    idx, uploaded_file, file_hash, result = futures[fut]
+                    with tabs[idx]:
+                        try:
+                            csv_bytes, pptx_bytes, word_bytes = fut.result()
+                        except Exception as e:
+                            print(f"处理 {uploaded_file.name} 时发生错误: {str(e)}")
+                            st.error(f"❌ 处理失败：{uploaded_file.name}")
+                        else:
+                            st.session_state.processed[file_hash] = (result, csv_bytes, pptx_bytes, word_bytes)
+                            show_result(uploaded_file.name, result, csv_bytes, pptx_bytes, word_bytes)
+
+                            # 保存记录到历史
+                            record_id = str(uuid.uuid4())
+                            now = datetime.now()
+                            record = {
+                                "id": record_id,
+                                "文件名": uploaded_file.name,
+                                "hash": file_hash,
+                                "时间": now.strftime("%Y-%m-%d %H:%M:%S"),
+                                "ts": int(now.timestamp()),
+                                "提取内容": result.strip(),
+                                "files": save_record_files(record_id, csv_bytes, pptx_bytes, word_bytes)
+                            }
+                            st.session_state.history.append(record)
+                            save_history(st.session_state.history)
+                    status_placeholder.info(f"📊 已生成 {done}/{len(futures)} 篇文献的报告")
+                    progress_bar.progress(0.5 + 0.5 * done / len(futures))
+
+                progress_placeholder.empty()
+                status_placeholder.empty()
+
+            st.markdown("---")
+            st.subheader("📜 历史处理记录")
+            # 分页展示，最新的记录在前
+            records = st.session_state.history[::-1]
+            page_count = max(1, (len(records) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE)
+            page_no = st.number_input("页码", min_value=1, max_value=page_count, value=1, step=1)
+            for record in records[(page_no - 1) * HISTORY_PAGE_SIZE:page_no * HISTORY_PAGE_SIZE]:
+                with st.expander(f"📄 `{record['文件名']}`"):
+                    col1, col2 = st.columns([0.9, 0.1])
+                    with col1:
+                        st.markdown(f"📁 文件 Hash: `{record['hash']}`")
+                        st.markdown(f"⏰ 时间: {record['时间']}")
+                        st.markdown(f"📄 提取内容:\n{record['提取内容']}")
+
+                        # 展开后才从本地文件读取数据并提供下载
+                        if st.toggle("📂 展开下载", key=f"open_{record['id']}"):
                             st.markdown(f"#### 下载文件:")
                             download_col1, download_col2, download_col3 = st.columns(3)
                             with download_col1:
                                 try:
-                                    csv_data = base64.b64decode(record['文件数据']['CSV'])
+                                    csv_data = load_record_file(record['files']['CSV'])
                                     st.download_button("📥 下载 CSV", 
                                                     data=csv_data, 
                                                     file_name=f"{record['文件名']}_结构化.csv",
@@ -619,10 +623,10 @@ if page == "主页":
                                                     key=f"csv_{record['id']}")
                                 except Exception as e:
                                     st.error(f"CSV数据加载失败")
-                            
+
                             with download_col2:
                                 try:
-                                    pptx_data = base64.b64decode(record['文件数据']['PPT'])
+                                    pptx_data = load_record_file(record['files']['PPT'])
                                     st.download_button("📊 下载 PPT", 
                                                     data=pptx_data,
                                                     file_name=f"{record['文件名']}_结构化.pptx",
@@ -630,10 +634,10 @@ if page == "主页":
                                                     key=f"ppt_{record['id']}")
                                 except Exception as e:
                                     st.error(f"PPT数据加载失败")
-                            
+
                             with download_col3:
                                 try:
-                                    word_data = base64.b64decode(record['文件数据']['Word'])
+                                    word_data = load_record_file(record['files']['Word'])
                                     st.download_button("📄 下载 Word",
                                                     data=word_data,
                                                     file_name=f"{record['文件名']}_结构化.docx",
@@ -641,16 +645,20 @@ if page == "主页":
                                                     key=f"word_{record['id']}")
                                 except Exception as e:
                                     st.error(f"Word数据加载失败")
-                            
-                        with col2:
-                            if st.button("🗑️", key=f"delete_{record['id']}", help="删除此记录"):
-                                delete_record(record['id'])
-                                st.rerun()
-    else:
-        st.info("请上传至少一个PDF文件以开始处理。")                           
 
-elif page == "后台管理":
-    admin_dashboard()
+                    with col2:
+                        if st.button("🗑️", key=f"delete_{record['id']}", help="删除此记录"):
+                            delete_record(record['id'])
+                            st.rerun()
+        else:
+            st.info("请上传至少一个PDF文件以开始处理。")                           
+
+    elif page == "后台管理":
+        admin_dashboard()
+
+    st.markdown("---")
+    st.markdown("© 2025 博扶AI创意组 · 医学文献结构化助手")
 
-st.markdown("---")
-st.markdown("© 2025 博扶AI创意组 · 医学文献结构化助手")
+# spawn 方式启动的子进程会以 __mp_main__ 的名义重新导入本脚本，此时不执行页面逻辑
+if __name__ != "__mp_main__":
+    main()
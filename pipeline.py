@@ -0,0 +1,212 @@
+import fitz
+import multiprocessing
+import os
+from pptx import Presentation
+from pptx.util import Pt, Inches
+from pptx.enum.text import PP_ALIGN
+from pptx.dml.color import RGBColor
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn
+from docx import Document
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from io import BytesIO
+from datetime import datetime
+from functools import lru_cache
+import io
+import csv
+import copy
+import re
+
+
+# ===== 配置 =====
+# 文本提取与报告生成在子进程中运行，本模块不依赖 Streamlit，可被子进程直接导入
+
+LOGO_PATH = "bofu_logo.png"
+
+# 批处理进程池由 Streamlit 主进程创建，主进程内运行着 Tornado 等多个线程，fork 不安全，显式使用 spawn
+BATCH_MP_CONTEXT = multiprocessing.get_context("spawn")
+# 按页并行的进程池在批处理子进程中创建；主脚本在子进程中重新导入时不读取 st.secrets、不执行页面逻辑，不会启动额外线程，可以安全地 fork
+PAGE_MP_CONTEXT = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Markdown 表格数据行（跳过分隔行与表头），只取前两列；逐行匹配，允许缺少结尾竖线
+_ROW_RE = re.compile(r"^\|(?![^\S\n]*:?-+:?[^\S\n]*\||[^\S\n]*要素)[^\S\n]*([^|\n]+?)[^\S\n]*\|[^\S\n]*([^|\n]*?)[^\S\n]*(?:\||$)", re.M)
+# PDF 文本提取选项：展开连字（ﬁ → fi），省去保留连字的处理，输出也更适合模型阅读
+_TEXT_FLAGS = fitz.TEXTFLAGS_BLOCKS & ~fitz.TEXT_PRESERVE_LIGATURES
+
+# ===== 报告生成入口 =====
+def _parse_result(md):
+    """将模型输出的 Markdown 表格解析为 (要素, 内容) 列表"""
+    return _ROW_RE.findall(md)
+
+def build_reports(result, name):
+    """根据模型输出生成 CSV/PPT/Word（不调用 Streamlit，可在子进程中运行）"""
+    rows = _parse_result(result)
+    csv_bytes = generate_csv(rows)
+    pptx_bytes = generate_ppt(result, rows, name)
+    word_bytes = generate_word_table(rows, "博扶AI创意组", name)
+    return csv_bytes, pptx_bytes, word_bytes
+
+# ===== 文本提取函数 =====
+def _extract_range(args):
+    """提取 [lo, hi) 页范围内的文本块，供进程池按页分片调用
+
+    参考 PyMuPDF 多进程示例：https://pymupdf.readthedocs.io/en/latest/recipes-multiprocessing.html
+    """
+    file_bytes, lo, hi = args
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        # 只保留文本块（type 0）中长度超过 20 的内容
+        return [t for i in range(lo, hi) for b in doc[i].get_text("blocks", sort=False, flags=_TEXT_FLAGS)
+                if b[6] == 0 and len(t := b[4].strip()) > 20]
+    finally:
+        doc.close()
+
+def extract_text_from_pdf(file_bytes: bytes, workers=1):
+    """提取 PDF 文本，页数较多时按页分片并行提取"""
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        n = doc.page_count
+    w = min(workers, n)
+    if w > 1 and n >= 8:
+        with PAGE_MP_CONTEXT.Pool(w) as pool:
+            chunks = pool.map(_extract_range, [(file_bytes, i * n // w, (i + 1) * n // w) for i in range(w)])
+    else:
+        chunks = [_extract_range((file_bytes, 0, n))]
+    return "\n".join(t for chunk in chunks for t in chunk)
+
+# ===== 文档生成函数 =====
+def generate_csv(rows):
+    """生成 CSV，含逗号等特殊字符的内容会被正确转义"""
+    csv_bytes = BytesIO()
+    # 逐行编码写入字节流，不再拼接整段字符串
+    wrapper = io.TextIOWrapper(csv_bytes, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(wrapper, quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(["要素", "内容"])
+    writer.writerows(rows)
+    wrapper.detach()  # 解除绑定，避免 wrapper 回收时关闭 csv_bytes
+    csv_bytes.seek(0)
+    return csv_bytes
+
+def generate_word_table(rows, team_name, source_file):
+    doc = Document()
+    heading = doc.add_heading(f"{team_name} · 临床研究结构化提取报告", 0)
+    heading.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    subtitle = doc.add_paragraph(f"📄 来源文献：{source_file}", style="Intense Quote")
+    subtitle.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    doc.add_paragraph()
+    table = doc.add_table(rows=0, cols=2)
+    table.style = 'Table Grid'
+    for key, value in rows:
+        cells = table.add_row().cells
+        cells[0].text = key
+        cells[1].text = value
+    for row in table.rows:
+        for cell in row.cells:
+            for para in cell.paragraphs:
+                para.paragraph_format.line_spacing = 1.5
+                para.paragraph_format.space_after = Pt(6)
+                para.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+                para.runs[0].font.size = Pt(11)
+    doc.add_paragraph(f"导出时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    word_stream = BytesIO()
+    doc.save(word_stream)
+    word_stream.seek(0)
+    return word_stream
+
+# 正文默认字符样式：18pt 微软雅黑
+_BODY_LVL1_XML = f'<a:lvl1pPr {nsdecls("a")}><a:defRPr sz="1800"><a:latin typeface="微软雅黑"/></a:defRPr></a:lvl1pPr>'
+
+def _apply_body_style(text_frame):
+    """把正文样式写入文本框的 lstStyle，所有段落直接继承，无需逐个 run 设置"""
+    tx_body = text_frame._txBody
+    lst_style = tx_body.find(qn("a:lstStyle"))
+    if lst_style is None:
+        lst_style = parse_xml(f'<a:lstStyle {nsdecls("a")}/>')
+        tx_body.bodyPr.addnext(lst_style)
+    lst_style.append(parse_xml(_BODY_LVL1_XML))
+
+@lru_cache(maxsize=None)
+def _blank_prs():
+    """每个进程只解析一次默认模板，之后按需深拷贝"""
+    prs = Presentation()
+    prs.slide_width = Inches(13.33)
+    prs.slide_height = Inches(7.5)
+    return prs
+
+def generate_ppt(result, rows, source_file):
+    """生成带 LOGO 封面的 PPT"""
+    # 深拷贝内存中的空白模板，比从磁盘模板文件重新打开（需再次解压解析 zip）更快
+    prs = copy.deepcopy(_blank_prs())
+
+    # 封面页
+    cover = prs.slides.add_slide(prs.slide_layouts[6])
+    title_box = cover.shapes.add_textbox(Inches(1), Inches(0.8), Inches(11), Inches(1.5))
+    tf = title_box.text_frame
+    p = tf.paragraphs[0]
+    run = p.add_run()
+    run.text = "研究设计提取报告"
+    run.font.size = Pt(42)
+    run.font.name = "微软雅黑"
+    run.font.bold = True
+    run.font.color.rgb = RGBColor(0, 51, 102)
+    p.alignment = PP_ALIGN.CENTER
+
+    if os.path.exists(LOGO_PATH):
+        cover.shapes.add_picture(LOGO_PATH, Inches(4.8), Inches(2.0), height=Inches(0.6))
+
+    sub_box = cover.shapes.add_textbox(Inches(1), Inches(4.0), Inches(11), Inches(0.8))
+    tf2 = sub_box.text_frame
+    tf2.text = f"源文件：  {source_file}"
+    tf2.paragraphs[0].font.size = Pt(20)
+    tf2.paragraphs[0].font.name = "微软雅黑"
+    tf2.paragraphs[0].alignment = PP_ALIGN.CENTER
+
+    # 内容页
+    for i, (key, value) in enumerate(rows):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        title_shape = slide.shapes.title
+        title_shape.text = key
+        title_frame = title_shape.text_frame
+        title_frame.paragraphs[0].alignment = PP_ALIGN.LEFT
+        title_run = title_frame.paragraphs[0].runs[0]
+        title_run.font.name = "微软雅黑"
+        title_run.font.bold = True
+        title_run.font.color.rgb = RGBColor(0, 51, 102)
+
+        textbox = slide.placeholders[1]
+        textbox.text = value.replace("；", "\n")
+        _apply_body_style(textbox.text_frame)
+
+        footer = slide.shapes.add_textbox(Inches(0.5), Inches(6.9), Inches(12), Inches(0.5))
+        tf_footer = footer.text_frame
+        tf_footer.text = f"博扶AI创意组 · 结构化助手 · 第 {i+1} 页"
+        tf_footer.paragraphs[0].font.size = Pt(10)
+        tf_footer.paragraphs[0].font.name = "微软雅黑"
+        tf_footer.paragraphs[0].alignment = PP_ALIGN.RIGHT
+
+    # 添加补充说明页
+    if "补充说明" in result:
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        title_shape = slide.shapes.title
+        title_shape.text = "补充说明"
+        title_frame = title_shape.text_frame
+        title_frame.paragraphs[0].alignment = PP_ALIGN.LEFT
+        title_run = title_frame.paragraphs[0].runs[0]
+        title_run.font.name = "微软雅黑"
+        title_run.font.bold = True
+        title_run.font.color.rgb = RGBColor(0, 51, 102)
+
+        textbox = slide.placeholders[1]
+        textbox.text = result.split("补充说明：")[1].strip()
+        _apply_body_style(textbox.text_frame)
+
+        footer = slide.shapes.add_textbox(Inches(0.5), Inches(6.9), Inches(12), Inches(0.5))
+        tf_footer = footer.text_frame
+        tf_footer.text = f"博扶AI创意组 · 结构化助手 · 补充说明页"
+        tf_footer.paragraphs[0].font.size = Pt(10)
+        tf_footer.paragraphs[0].font.name = "微软雅黑"
+        tf_footer.paragraphs[0].alignment = PP_ALIGN.RIGHT
+
+    pptx_bytes = BytesIO()
+    prs.save(pptx_bytes)
+    pptx_bytes.seek(0)
+    return pptx_bytes